@@ -0,0 +1,583 @@
+# ===- detailed_operator_profiler.py --------------------------------------
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ===---------------------------------------------------------------------------
+#
+# DeepSeek R1 Transformer Block Detailed Operator Profiler
+#
+# Times each component of the transformer block (layernorms, attention
+# sub-operations, FFN sub-operations, residual connections) individually.
+# On GPU the block-level components are captured into CUDA graphs once and
+# replayed, so per-iteration Python dispatch and kernel-launch overhead do
+# not pollute the measurements.
+#
+# ===---------------------------------------------------------------------------
+
+import argparse
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from fused_kernels import fused_add_rmsnorm, swiglu_fused
+from operator_profiler import dump_json_report, prepare_device_inputs
+from transformer_model import create_sample_inputs, create_transformer_model
+
+
+class DetailedOperatorProfiler:
+    """Profile the transformer block at sub-operator granularity."""
+
+    def __init__(self, num_iterations=100, num_warmup=10):
+        self.num_iterations = num_iterations
+        self.num_warmup = num_warmup
+        # Timings live in per-op arrays pre-sized to num_iterations and
+        # addressed by a registered index, so the hot loops store by
+        # offset instead of paying a dict hash plus list growth check for
+        # every one of the ~num_ops x num_iterations measurements.
+        self._op_index = {}
+        self._op_arrays = []
+        self._op_cursors = []
+        self._op_events = []
+        # Disabled during warmup so the instrumented passes can run
+        # without polluting the measurements.
+        self._recording = True
+        self._use_cuda_events = torch.cuda.is_available()
+
+    def _op_slot(self, name):
+        """Return the storage index for an op, registering it lazily."""
+        idx = self._op_index.get(name)
+        if idx is None:
+            idx = len(self._op_arrays)
+            self._op_index[name] = idx
+            self._op_arrays.append(
+                np.empty(self.num_iterations, dtype=np.float64)
+            )
+            self._op_cursors.append(0)
+            # One reusable CUDA event pair per op: allocating fresh
+            # events on every measurement costs two host-side calls per
+            # op per iteration for objects that are safely re-recordable.
+            self._op_events.append(
+                (
+                    torch.cuda.Event(enable_timing=True),
+                    torch.cuda.Event(enable_timing=True),
+                )
+                if self._use_cuda_events
+                else None
+            )
+        return idx
+
+    def _record(self, idx, duration_ms):
+        """Store one measurement at the op's cursor position."""
+        arr = self._op_arrays[idx]
+        cursor = self._op_cursors[idx]
+        if cursor == arr.size:
+            arr = np.concatenate(
+                [arr, np.empty(arr.size, dtype=np.float64)]
+            )
+            self._op_arrays[idx] = arr
+        arr[cursor] = duration_ms
+        self._op_cursors[idx] = cursor + 1
+
+    def _iter_op_times(self):
+        """Yield (name, measurements) for every registered op."""
+        for name, idx in self._op_index.items():
+            yield name, self._op_arrays[idx][: self._op_cursors[idx]]
+
+    @contextmanager
+    def profile_operation(self, name):
+        """Time one operation and append the duration in milliseconds.
+
+        On GPU a CUDA event pair measures device-side execution:
+        time.perf_counter() returns as soon as the launches are enqueued,
+        so it records launch latency rather than kernel time.
+        Synchronizing only on the end event avoids a host-wide
+        torch.cuda.synchronize() between operations.
+        """
+        if not self._recording:
+            yield
+            return
+        idx = self._op_slot(name)
+        if self._use_cuda_events:
+            start_evt, end_evt = self._op_events[idx]
+            start_evt.record()
+            yield
+            end_evt.record()
+            end_evt.synchronize()
+            self._record(idx, start_evt.elapsed_time(end_evt))
+        else:
+            start = time.perf_counter()
+            yield
+            duration_ms = (time.perf_counter() - start) * 1000.0
+            self._record(idx, duration_ms)
+
+    def profile_transformer_components(
+        self, model, hidden_states, attention_mask
+    ):
+        """Profile the block-level components, then their sub-operations."""
+        # Warm up so lazy initialization does not skew the measurements.
+        with torch.inference_mode():
+            for _ in range(self.num_warmup):
+                model(hidden_states, attention_mask)
+
+        if hidden_states.is_cuda:
+            self._profile_block_components_graphed(
+                model, hidden_states, attention_mask
+            )
+        else:
+            self._profile_block_components_eager(
+                model, hidden_states, attention_mask
+            )
+
+        # Profile the attention and FFN internals in one shared pass over
+        # the block, so each sub-operation sees the tensor its component
+        # actually consumes.
+        self._profile_sub_operations(model, hidden_states, attention_mask)
+
+    def _block_components(self, model, hidden_states, attention_mask):
+        """Build (name, callable) pairs for the block-level components.
+
+        The intermediate tensors are computed once up front so that every
+        component callable reads fixed buffers; this is what makes the
+        callables CUDA-graph capturable.
+        """
+        normed_input = model.input_layernorm(hidden_states)
+        attn_output = model.self_attn(normed_input, attention_mask)
+        hidden_after_attn, normed_attn = fused_add_rmsnorm(
+            hidden_states,
+            attn_output,
+            model.post_attention_layernorm.weight,
+            model.post_attention_layernorm.eps,
+        )
+        ffn_output = model.mlp(normed_attn)
+
+        return [
+            (
+                "InputLayerNorm",
+                lambda: model.input_layernorm(hidden_states),
+            ),
+            (
+                "SelfAttention",
+                lambda: model.self_attn(normed_input, attention_mask),
+            ),
+            # The residual add and the following RMSNorm run as one fused
+            # Triton kernel, so they are timed as one component. The final
+            # residual has no trailing norm inside a single block and stays
+            # separate.
+            (
+                "FusedAddRMSNorm",
+                lambda: fused_add_rmsnorm(
+                    hidden_states,
+                    attn_output,
+                    model.post_attention_layernorm.weight,
+                    model.post_attention_layernorm.eps,
+                ),
+            ),
+            (
+                "FFN",
+                lambda: model.mlp(normed_attn),
+            ),
+            (
+                "ResidualConnection2",
+                lambda: hidden_after_attn + ffn_output,
+            ),
+        ]
+
+    def _profile_block_components_graphed(
+        self, model, hidden_states, attention_mask
+    ):
+        """Capture each block component into a CUDA graph and replay it.
+
+        A graph replay is a single launch, so the per-iteration cost of
+        Python dispatch and the dozen small kernel launches inside each
+        component disappears from the timing loop. Timing uses CUDA event
+        pairs, which measure device-side execution rather than host-side
+        enqueue latency.
+        """
+        components = self._block_components(
+            model, hidden_states, attention_mask
+        )
+
+        for name, fn in components:
+            # Warm up on a side stream as required before graph capture.
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(3):
+                    fn()
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                fn()
+
+            idx = self._op_slot(name)
+            start_evt, end_evt = self._op_events[idx]
+            for _ in range(self.num_iterations):
+                start_evt.record()
+                graph.replay()
+                end_evt.record()
+                end_evt.synchronize()
+                self._record(idx, start_evt.elapsed_time(end_evt))
+
+    def _profile_block_components_eager(
+        self, model, hidden_states, attention_mask
+    ):
+        """Eager fallback for hosts without CUDA."""
+        components = self._block_components(
+            model, hidden_states, attention_mask
+        )
+        # inference_mode wraps the whole loop once: entering no_grad per
+        # iteration costs two Python context switches each time, and
+        # inference_mode additionally skips version-counter bumps.
+        with torch.inference_mode():
+            for _ in range(self.num_warmup):
+                for _, fn in components:
+                    fn()
+            for _ in range(self.num_iterations):
+                for name, fn in components:
+                    with self.profile_operation(name):
+                        fn()
+
+    @staticmethod
+    def _get_qkv_proj(attention_module):
+        """Return a fused Q/K/V projection for the attention module.
+
+        The three projections consume the same input, so a single GEMM
+        over the concatenated weights reads hidden_states once instead of
+        three times and replaces three kernel launches with one. The fused
+        linear is built lazily from the existing weights and cached on the
+        module.
+        """
+        qkv_proj = getattr(attention_module, "qkv_proj", None)
+        if qkv_proj is None:
+            q_weight = attention_module.q_proj.weight
+            k_weight = attention_module.k_proj.weight
+            v_weight = attention_module.v_proj.weight
+            qkv_proj = torch.nn.Linear(
+                attention_module.hidden_size,
+                q_weight.size(0) + k_weight.size(0) + v_weight.size(0),
+                bias=False,
+                device=q_weight.device,
+                dtype=q_weight.dtype,
+            )
+            with torch.no_grad():
+                qkv_proj.weight.copy_(
+                    torch.cat([q_weight, k_weight, v_weight], dim=0)
+                )
+            attention_module.qkv_proj = qkv_proj
+        return qkv_proj
+
+    def _profile_sub_operations(self, model, hidden_states, attention_mask):
+        """Profile attention and FFN sub-operations in one shared pass.
+
+        The attention and FFN internals were previously timed by two
+        independent loops that each re-ran the surrounding pipeline for
+        another num_iterations, roughly tripling the total GPU work and
+        letting warm-cache state drift between the runs. A single loop
+        now threads every iteration through the whole block and records
+        all sub-operation timings from the same forward pass.
+        """
+        attention_module = model.self_attn
+        batch_size, seq_len, _ = hidden_states.size()
+
+        qkv_proj = self._get_qkv_proj(attention_module)
+        head_dim = attention_module.head_dim
+        qkv_split_sizes = [
+            attention_module.num_attention_heads * head_dim,
+            attention_module.num_key_value_heads * head_dim,
+            attention_module.num_key_value_heads * head_dim,
+        ]
+
+        # Build the additive mask once; it is constant across iterations.
+        sdpa_mask = None
+        if attention_mask is not None:
+            mask = attention_mask.view(batch_size, 1, 1, seq_len)
+            mask = mask.to(hidden_states.dtype)
+            sdpa_mask = (1.0 - mask) * -10000.0
+
+        def run_block():
+            normed_input = model.input_layernorm(hidden_states)
+            attn_output = self._instrumented_attention(
+                attention_module,
+                normed_input,
+                sdpa_mask,
+                qkv_proj,
+                qkv_split_sizes,
+            )
+            _, normed_attn = fused_add_rmsnorm(
+                hidden_states,
+                attn_output,
+                model.post_attention_layernorm.weight,
+                model.post_attention_layernorm.eps,
+            )
+            self._instrumented_ffn(model.mlp, normed_attn)
+
+        # inference_mode wraps the loops once instead of re-entering
+        # no_grad every iteration. The warmup runs the exact kernels the
+        # timed loop runs (fused QKV, SDPA, Triton ops) with recording
+        # off, so autotuning and lazy init stay out of the min values.
+        with torch.inference_mode():
+            self._recording = False
+            for _ in range(self.num_warmup):
+                run_block()
+            self._recording = True
+            for _ in range(self.num_iterations):
+                run_block()
+
+    def _instrumented_attention(
+        self,
+        attention_module,
+        hidden_states,
+        sdpa_mask,
+        qkv_proj,
+        qkv_split_sizes,
+    ):
+        """Run the attention block once, timing each sub-operation."""
+        batch_size, seq_len, _ = hidden_states.size()
+        num_heads = attention_module.num_attention_heads
+        num_kv_heads = attention_module.num_key_value_heads
+        head_dim = attention_module.head_dim
+
+        with self.profile_operation("Attention_QKVProjection"):
+            qkv = qkv_proj(hidden_states)
+            query_states, key_states, value_states = torch.split(
+                qkv, qkv_split_sizes, dim=-1
+            )
+
+        # view/transpose only rewrite tensor metadata and launch no
+        # kernels, so they stay outside the timed regions: reporting them
+        # as a distinct cost (or folding them into a neighbouring kernel's
+        # timing) would misattribute pure host-side bookkeeping.
+        query_states = query_states.view(
+            batch_size, seq_len, num_heads, head_dim
+        ).transpose(1, 2)
+        key_states = key_states.view(
+            batch_size, seq_len, num_kv_heads, head_dim
+        ).transpose(1, 2)
+        value_states = value_states.view(
+            batch_size, seq_len, num_kv_heads, head_dim
+        ).transpose(1, 2)
+
+        # One fused kernel replaces MatMul1 -> Softmax -> MatMul2.
+        # The FlashAttention-style backends never materialize the
+        # [B, H, S, S] score matrix, cutting HBM traffic from
+        # O(B*H*S^2) to O(B*H*S*D) at identical FLOPs.
+        # K/V keep their native num_key_value_heads; enable_gqa
+        # broadcasts them inside the kernel, so no repeat_interleave
+        # copy num_heads/num_kv_heads times larger is materialized.
+        with self.profile_operation("Attention_SDPA"):
+            attn_output = F.scaled_dot_product_attention(
+                query_states,
+                key_states,
+                value_states,
+                attn_mask=sdpa_mask,
+                scale=attention_module.scale,
+                enable_gqa=True,
+            )
+
+        # The [B, H, S, D] -> [B, S, H*D] re-layout cannot be a view for
+        # S > 1, so reshape still materializes the same copy the old
+        # .contiguous().view(...) did. It exists only to feed the
+        # projection GEMM's input layout, so it is timed together with
+        # the projection instead of being reported as a separate op.
+        with self.profile_operation("Attention_OutputProjection"):
+            attn_output = attention_module.o_proj(
+                attn_output.transpose(1, 2).reshape(
+                    batch_size, seq_len, num_heads * head_dim
+                )
+            )
+
+        return attn_output
+
+    def _instrumented_ffn(self, ffn_module, hidden_states):
+        """Run the FFN block once, timing each sub-operation."""
+        with self.profile_operation("FFN_GateProjection"):
+            gate = ffn_module.gate_proj(hidden_states)
+        with self.profile_operation("FFN_UpProjection"):
+            up = ffn_module.up_proj(hidden_states)
+        # SiLU and the gating multiply run as one fused kernel, so the
+        # intermediate tensor stays in registers between them.
+        with self.profile_operation("FFN_SwiGLUFused"):
+            intermediate = swiglu_fused(gate, up)
+        with self.profile_operation("FFN_DownProjection"):
+            output = ffn_module.down_proj(intermediate)
+        return output
+
+    def get_report(self):
+        """Build the aggregate statistics for every profiled operation."""
+        report = {}
+        for name, times in self._iter_op_times():
+            # Single C-level reductions instead of Python iterations.
+            report[name] = {
+                "avg_time_ms": float(times.mean()),
+                "min_time_ms": float(times.min()),
+                "max_time_ms": float(times.max()),
+                "total_time_ms": float(times.sum()),
+                "total_calls": int(times.size),
+            }
+        return report
+
+    def print_report(self):
+        """Print the per-operation statistics sorted by total time."""
+        print("\n" + "=" * 80)
+        print("Detailed Operator Profile Report")
+        print("=" * 80)
+        print(
+            f"{'Operation':<32}{'Avg (ms)':>10}{'Min (ms)':>10}"
+            f"{'Max (ms)':>10}{'Total (ms)':>12}{'Calls':>8}"
+        )
+        print("-" * 82)
+        # Compute each op's totals once and sort by them, instead of
+        # re-summing inside the sort key and per printed column.
+        totals = {
+            name: float(times.sum()) for name, times in self._iter_op_times()
+        }
+        for name, times in sorted(
+            self._iter_op_times(),
+            key=lambda x: totals[x[0]],
+            reverse=True,
+        ):
+            print(
+                f"{name:<32}"
+                f"{times.mean():>10.4f}"
+                f"{times.min():>10.4f}"
+                f"{times.max():>10.4f}"
+                f"{totals[name]:>12.4f}"
+                f"{times.size:>8}"
+            )
+
+    def save_report(self, filename="detailed_operator_profile.json"):
+        """Save the aggregate statistics as JSON."""
+        report = self.get_report()
+        dump_json_report(report, filename)
+        print(f"Report saved to {filename}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DeepSeek R1 Transformer Block Detailed Operator Profiler"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default="./",
+        help="Directory to save profiling reports.",
+    )
+    parser.add_argument(
+        "--num-iterations",
+        type=int,
+        default=100,
+        help="Number of profiled iterations per operation.",
+    )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Profile the eager submodules instead of compiled ones.",
+    )
+    parser.add_argument(
+        "--int8-ffn",
+        action="store_true",
+        help=(
+            "Quantize the FFN weights to int8 (requires torchao). With "
+            "--no-compile the per-projection timings reflect the unfused "
+            "dequant+matmul path."
+        ),
+    )
+    parser.add_argument(
+        "--fp32",
+        action="store_true",
+        help="Keep fp32 precision instead of casting to bfloat16 on GPU.",
+    )
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # The whole session is inference: turn autograd off globally once so
+    # no per-op version-counter or graph-tracking overhead remains, and
+    # let cuDNN autotune its algorithms — the shapes are fixed, so the
+    # first-call search is amortized by the warmup.
+    torch.set_grad_enabled(False)
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+
+    model = create_transformer_model()
+    hidden_states, attention_mask = create_sample_inputs()
+    if torch.cuda.is_available():
+        model = model.cuda()
+        if not args.fp32:
+            # See operator_profiler: the workload is bandwidth-bound, so
+            # bfloat16 halves HBM traffic and uses BF16 tensor cores.
+            # Only compare reports of matching precision.
+            model = model.to(torch.bfloat16)
+            hidden_states = hidden_states.to(torch.bfloat16)
+            attention_mask = attention_mask.to(torch.bfloat16)
+        hidden_states, attention_mask = prepare_device_inputs(
+            hidden_states, attention_mask
+        )
+
+    if args.int8_ffn:
+        # At batch=1 the FFN GEMMs are weight-bandwidth-bound, so int8
+        # weights halve their HBM traffic. Attention projections are left
+        # in full precision; quantizing them yields negligible gains.
+        # torch.compile is required to emit the fused int8 matmul kernel;
+        # eager falls back to separate dequant + matmul kernels.
+        try:
+            from torchao.quantization import int8_weight_only, quantize_
+
+            quantize_(model.mlp, int8_weight_only())
+            if not args.no_compile:
+                # The sub-operation pass calls gate/up/down_proj directly,
+                # bypassing the compiled model.mlp wrapper, so each
+                # projection needs its own compiled wrapper for the timed
+                # GEMMs to run the fused int8 kernel.
+                model.mlp.gate_proj = torch.compile(
+                    model.mlp.gate_proj, dynamic=False
+                )
+                model.mlp.up_proj = torch.compile(
+                    model.mlp.up_proj, dynamic=False
+                )
+                model.mlp.down_proj = torch.compile(
+                    model.mlp.down_proj, dynamic=False
+                )
+        except ImportError:
+            print("torchao is not installed; keeping full-precision FFN.")
+
+    if not args.no_compile:
+        # Compile each submodule independently so the per-component
+        # timings stay meaningful. Default mode (not reduce-overhead) is
+        # required here: the profiler captures the components into its own
+        # CUDA graphs, which cannot nest inside inductor's cudagraphs.
+        model.input_layernorm = torch.compile(
+            model.input_layernorm, dynamic=False
+        )
+        model.self_attn = torch.compile(model.self_attn, dynamic=False)
+        model.post_attention_layernorm = torch.compile(
+            model.post_attention_layernorm, dynamic=False
+        )
+        model.mlp = torch.compile(model.mlp, dynamic=False)
+
+    profiler = DetailedOperatorProfiler(num_iterations=args.num_iterations)
+    profiler.profile_transformer_components(
+        model, hidden_states, attention_mask
+    )
+    profiler.print_report()
+    profiler.save_report(
+        os.path.join(args.output_dir, "detailed_operator_profile.json")
+    )
+
+
+if __name__ == "__main__":
+    main()
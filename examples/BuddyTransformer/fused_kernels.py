@@ -0,0 +1,146 @@
+# ===- fused_kernels.py ---------------------------------------------------
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ===---------------------------------------------------------------------------
+#
+# Fused Triton kernels for the DeepSeek R1 transformer profiling path.
+#
+# The kernels fuse memory-bound elementwise patterns that eager PyTorch
+# executes as separate passes over the hidden-state tensor. Each fused op
+# falls back to the equivalent eager computation when Triton or CUDA is
+# unavailable, so the profilers stay runnable on CPU-only hosts.
+#
+# ===---------------------------------------------------------------------------
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+
+if HAS_TRITON:
+
+    @triton.jit
+    def _fused_add_rmsnorm_kernel(
+        x_ptr,
+        y_ptr,
+        z_ptr,
+        out_ptr,
+        weight_ptr,
+        n_cols,
+        eps,
+        BLOCK_N: tl.constexpr,
+    ):
+        # One program per row: compute z = x + y, accumulate sum(z*z) in
+        # fp32, then write both z (next residual input) and the normalized
+        # output in a single pass over the row.
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK_N)
+        mask = cols < n_cols
+        offsets = row * n_cols + cols
+
+        x = tl.load(x_ptr + offsets, mask=mask, other=0.0).to(tl.float32)
+        y = tl.load(y_ptr + offsets, mask=mask, other=0.0).to(tl.float32)
+        z = x + y
+
+        variance = tl.sum(z * z, axis=0) / n_cols
+        rstd = 1.0 / tl.sqrt(variance + eps)
+        weight = tl.load(
+            weight_ptr + cols, mask=mask, other=0.0
+        ).to(tl.float32)
+
+        tl.store(z_ptr + offsets, z, mask=mask)
+        tl.store(out_ptr + offsets, z * rstd * weight, mask=mask)
+
+    @triton.jit
+    def _swiglu_kernel(
+        gate_ptr,
+        up_ptr,
+        out_ptr,
+        n_elements,
+        BLOCK: tl.constexpr,
+    ):
+        # Elementwise tiles: SiLU and the gating multiply happen in
+        # registers, so the [B, S, intermediate] tensor is read and
+        # written once instead of twice.
+        pid = tl.program_id(0)
+        offsets = pid * BLOCK + tl.arange(0, BLOCK)
+        mask = offsets < n_elements
+
+        gate = tl.load(gate_ptr + offsets, mask=mask, other=0.0).to(
+            tl.float32
+        )
+        up = tl.load(up_ptr + offsets, mask=mask, other=0.0).to(tl.float32)
+        out = gate * tl.sigmoid(gate) * up
+        tl.store(out_ptr + offsets, out, mask=mask)
+
+
+def fused_add_rmsnorm(x, y, weight, eps=1e-6):
+    """Fused residual-add + RMSNorm.
+
+    Computes ``z = x + y`` and ``rmsnorm(z) * weight`` in one kernel, so
+    the hidden-state tensor is read and written once instead of twice.
+    Returns ``(z, normed)``: ``z`` feeds the next residual connection and
+    ``normed`` feeds the next sub-layer.
+    """
+    if HAS_TRITON and x.is_cuda:
+        x = x.contiguous()
+        y = y.contiguous()
+        n_cols = x.shape[-1]
+        n_rows = x.numel() // n_cols
+        z = torch.empty_like(x)
+        out = torch.empty_like(x)
+        _fused_add_rmsnorm_kernel[(n_rows,)](
+            x,
+            y,
+            z,
+            out,
+            weight,
+            n_cols,
+            eps,
+            BLOCK_N=triton.next_power_of_2(n_cols),
+        )
+        return z, out
+
+    # Eager fallback mirroring the RMSNorm numerics of transformer_model.
+    z = x + y
+    z_fp32 = z.to(torch.float32)
+    variance = z_fp32.pow(2).mean(-1, keepdim=True)
+    normed = weight * (z_fp32 * torch.rsqrt(variance + eps)).to(x.dtype)
+    return z, normed
+
+
+def swiglu_fused(gate_out, up_out):
+    """Fused SwiGLU gating: ``silu(gate_out) * up_out`` in one kernel.
+
+    Eager PyTorch runs SiLU and the elementwise multiply as two separate
+    memory-bound passes over the intermediate tensor; the fused kernel
+    keeps both in registers.
+    """
+    if HAS_TRITON and gate_out.is_cuda:
+        gate_out = gate_out.contiguous()
+        up_out = up_out.contiguous()
+        out = torch.empty_like(gate_out)
+        n_elements = gate_out.numel()
+        BLOCK = 1024
+        grid = (triton.cdiv(n_elements, BLOCK),)
+        _swiglu_kernel[grid](gate_out, up_out, out, n_elements, BLOCK=BLOCK)
+        return out
+
+    return torch.nn.functional.silu(gate_out) * up_out
@@ -0,0 +1,224 @@
+# ===- operator_profiler.py -----------------------------------------------
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ===---------------------------------------------------------------------------
+#
+# DeepSeek R1 Transformer Block Operator Profiler
+#
+# Aggregates per-operator timings of the PyTorch reference model via the
+# native torch.profiler (Kineto) event stream. On GPU the timings come from
+# CUPTI, so they reflect real kernel durations instead of launch latencies.
+#
+# ===---------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from transformer_model import create_sample_inputs, create_transformer_model
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_json_report(report, filename):
+    """Write a report as JSON, via orjson when it is available.
+
+    orjson serializes several times faster than the stdlib json module
+    and handles NumPy scalars and arrays natively, so the report step
+    stays C-level end to end; without it the stdlib writer is used.
+    """
+    if orjson is not None:
+        with open(filename, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    report,
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY,
+                )
+            )
+    else:
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def prepare_device_inputs(hidden_states, attention_mask):
+    """Stage host input tensors into persistent device buffers.
+
+    Pinning the host tensors makes the H2D copies true asynchronous DMA
+    transfers; pageable memory would go through a synchronous staging
+    copy that serializes with kernel launches. The returned buffers live
+    on the device for the whole session and are reused by every profiled
+    iteration, which is also what CUDA graph capture expects as static
+    inputs.
+    """
+    hidden_states = hidden_states.pin_memory()
+    attention_mask = attention_mask.pin_memory()
+    device_hs = torch.empty_like(hidden_states, device="cuda")
+    device_mask = torch.empty_like(attention_mask, device="cuda")
+    device_hs.copy_(hidden_states, non_blocking=True)
+    device_mask.copy_(attention_mask, non_blocking=True)
+    return device_hs, device_mask
+
+
+class OperatorProfiler:
+    """Operator-level profiler built on the torch.profiler (Kineto) backend.
+
+    A single C++ tracer records every dispatched operator for the whole
+    inference loop, replacing per-module Python hooks and their
+    O(num_modules x num_iterations) dispatch overhead. With
+    ``record_shapes=True`` the aggregation groups identical operators by
+    input shape, which keeps the per-op granularity of a hook-based report.
+    """
+
+    def __init__(self, num_iterations=100, num_warmup=10):
+        self.num_iterations = num_iterations
+        self.num_warmup = num_warmup
+        self.prof = None
+
+    def run(self, model, hidden_states, attention_mask):
+        """Profile the inference loop and retain the Kineto trace."""
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        with torch.no_grad():
+            # Warm up outside the profiled region so lazy initialization and
+            # autotuning do not pollute the trace.
+            for _ in range(self.num_warmup):
+                model(hidden_states, attention_mask)
+
+            with profile(
+                activities=activities,
+                record_shapes=True,
+                with_stack=False,
+            ) as prof:
+                for _ in range(self.num_iterations):
+                    model(hidden_states, attention_mask)
+
+        self.prof = prof
+        return prof
+
+    def print_report(self, row_limit=30):
+        """Print the shape-aware operator summary sorted by self time."""
+        if self.prof is None:
+            raise RuntimeError("run() must be called before print_report().")
+        sort_by = (
+            "self_cuda_time_total"
+            if torch.cuda.is_available()
+            else "self_cpu_time_total"
+        )
+        print("\n" + "=" * 80)
+        print("Operator Profile Report (torch.profiler / Kineto)")
+        print("=" * 80)
+        print(
+            self.prof.key_averages(group_by_input_shape=True).table(
+                sort_by=sort_by, row_limit=row_limit
+            )
+        )
+
+    def save_report(
+        self,
+        filename="operator_profile.json",
+        trace_file="operator_trace.json",
+    ):
+        """Save a chrome trace plus a JSON dump of the averaged events."""
+        if self.prof is None:
+            raise RuntimeError("run() must be called before save_report().")
+        self.prof.export_chrome_trace(trace_file)
+
+        report = []
+        for evt in self.prof.key_averages(group_by_input_shape=True):
+            report.append(
+                {
+                    "name": evt.key,
+                    "count": evt.count,
+                    "input_shapes": str(evt.input_shapes),
+                    "cpu_time_total_us": evt.cpu_time_total,
+                    "self_cpu_time_total_us": evt.self_cpu_time_total,
+                    "device_time_total_us": evt.device_time_total,
+                    "self_device_time_total_us": evt.self_device_time_total,
+                }
+            )
+        dump_json_report(report, filename)
+        print(f"Report saved to {filename}, chrome trace to {trace_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DeepSeek R1 Transformer Block Operator Profiler"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default="./",
+        help="Directory to save profiling reports.",
+    )
+    parser.add_argument(
+        "--num-iterations",
+        type=int,
+        default=100,
+        help="Number of profiled inference iterations.",
+    )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Profile the eager model instead of the torch.compile'd one.",
+    )
+    parser.add_argument(
+        "--fp32",
+        action="store_true",
+        help="Keep fp32 precision instead of casting to bfloat16 on GPU.",
+    )
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    model = create_transformer_model()
+    hidden_states, attention_mask = create_sample_inputs()
+    if torch.cuda.is_available():
+        model = model.cuda()
+        if not args.fp32:
+            # The batch=1 workload is bandwidth-bound: bfloat16 halves the
+            # bytes moved per op and routes the matmuls through BF16
+            # tensor cores. Numerics differ from fp32, so only compare
+            # reports of matching precision.
+            model = model.to(torch.bfloat16)
+            hidden_states = hidden_states.to(torch.bfloat16)
+            attention_mask = attention_mask.to(torch.bfloat16)
+        hidden_states, attention_mask = prepare_device_inputs(
+            hidden_states, attention_mask
+        )
+
+    if not args.no_compile:
+        # Shapes are fixed (B=1, S=40), so CUDAGraph-backed reduce-overhead
+        # mode applies: inductor fuses the eager per-op dispatch into a few
+        # Triton kernels and replays them from a graph. The warmup inside
+        # run() covers autotuning and graph capture before tracing starts.
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+
+    profiler = OperatorProfiler(num_iterations=args.num_iterations)
+    profiler.run(model, hidden_states, attention_mask)
+    profiler.print_report()
+    profiler.save_report(
+        filename=os.path.join(args.output_dir, "operator_profile.json"),
+        trace_file=os.path.join(args.output_dir, "operator_trace.json"),
+    )
+
+
+if __name__ == "__main__":
+    main()